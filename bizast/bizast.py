@@ -4,8 +4,12 @@ import os.path
 import json
 import argparse
 import binascii
+import gzip
+import numbers
 import pkg_resources
 import re
+import socket
+import struct
 import urllib
 from distutils.dir_util import mkpath as mkdirs
 from collections import OrderedDict
@@ -13,15 +17,22 @@ import time
 
 from twisted.application import internet
 from twisted.python import log
-from twisted.web import resource, server
+import twisted.python.log
+from twisted.web import resource, server, proxy
+from twisted.web.client import Agent, HTTPConnectionPool, readBody
+from twisted.web.http_headers import Headers
 from twisted.web.resource import NoResource
-from twisted.internet import reactor, defer
+from twisted.internet import reactor, defer, protocol, threads
 from twisted.internet.task import react, LoopingCall, deferLater
+from twisted.names import dns, server as dnsserver
 from kademlia.network import Server
 from kademlia import log
+from kademlia.node import Node, NodeHeap
+from kademlia.crawling import RPCFindResponse
 import kademlia.storage
 import kademlia.utils
 import appdirs
+import requests
 import nacl.signing
 import nacl.hash
 from nacl.encoding import RawEncoder as eraw
@@ -30,8 +41,17 @@ from pqdict import PQDict
 
 default_webport = 62341
 urlmatch = re.compile('[a-zA-Z+]+://')
+hostportmatch = re.compile('^(?:\\[([0-9a-fA-F:.]+)\\]|([^:/\\[\\]]+)):[0-9]+$')
+dns_uri_type = 256
 webprotocol = 'bz://'
 webprotocol2 = 'web+bz://'
+# Raw size of the largest record within the name and message limits: every
+# character escaped as a \uXXXX surrogate pair, plus key, signature, version
+# and JSON overhead
+max_record_len = (64 + 512) * 12 + 1024
+max_page_len = 1000
+snapshot_batch_len = 200
+fresh_contact_age = 15 * 60
 
 
 def res(path):
@@ -57,78 +77,215 @@ def split_name_fingerprint(key):
     return parts
 
 
+def strip_protocol(key):
+    if key.startswith(webprotocol):
+        key = key[len(webprotocol):]
+    if key.startswith(webprotocol2):
+        key = key[len(webprotocol2):]
+    return key
+
+
+def is_address(family, host):
+    try:
+        socket.inet_pton(family, host)
+        return True
+    except (socket.error, ValueError):
+        return False
+
+
 def log_info(message):
     print(message)
     
     
-def validate(args, hashed_rec_key, value, oldvalue):
-    try:
-        value = json.loads(value)
-        if 'key' not in value:
-            raise ValueError('Missing field [key]')
-    except Exception as e:
-        if args.verbose:
-            log_info('Failed validation, record undecipherable: {}'.format(value))
-    try:
-        key = binascii.unhexlify(value['key'])
-        if 'signature' not in value:
-            raise ValueError('Missing field [signature]')
-        if 'version' not in value:
-            raise ValueError('Missing field [version]')
-        if 'message' not in value:
-            raise ValueError('Missing field [message]')
-        if 'name' not in value:
-            raise ValueError('Missing field [name]')
-        name = value['name']
-        if len(name) > 64:
-            raise ValueError('Resource name too long (>64 bytes)')
-        if len(value['message']) > 512:
-            raise ValueError('Message too long (>512 bytes)')
-        key = binascii.unhexlify(value['key'])
-        fingerprint = gen_fingerprint(key)
-        rec_key = '{}:{}'.format(name, fingerprint)
-        if hashed_rec_key is not None:
-            confirm_hashed_rec_key = kademlia.utils.digest(rec_key)
-            if confirm_hashed_rec_key != hashed_rec_key:
-                raise ValueError(
-                    'Hashed record keys don\'t match '
-                    '(got [{}], expected [{}])'.format(
-                        binascii.hexlify(hashed_rec_key),
-                        binascii.hexlify(confirm_hashed_rec_key),
-                    )
+def precheck(value, oldvalue):
+    """
+    Cheap structural checks on a raw record, run before any cryptography.
+    Returns the decoded record.
+    """
+    if len(value) > max_record_len:
+        raise ValueError('Record too long (>{} bytes)'.format(max_record_len))
+    value = json.loads(value)
+    if not isinstance(value, dict):
+        raise ValueError('Record is not an object')
+    for field in ('key', 'signature', 'version', 'message', 'name'):
+        if field not in value:
+            raise ValueError('Missing field [{}]'.format(field))
+    if not isinstance(value['version'], numbers.Integral):
+        raise ValueError('Version is not an integer')
+    if len(value['key']) != 64:
+        raise ValueError('Key has wrong length')
+    if len(value['signature']) != 128:
+        raise ValueError('Signature has wrong length')
+    if len(value['name']) > 64:
+        raise ValueError('Resource name too long (>64 bytes)')
+    if len(value['message']) > 512:
+        raise ValueError('Message too long (>512 bytes)')
+    if oldvalue:
+        oldvalue = json.loads(oldvalue)
+        if oldvalue['version'] >= value['version']:
+            raise ValueError(
+                'Version is too old (existing [{}], new [{}])'.format(
+                    oldvalue['version'],
+                    value['version'],
                 )
-        signature = binascii.unhexlify(value['signature'])
-        nacl.signing.VerifyKey(key, encoder=eraw).verify(
-            plaintext(value), signature, encoder=eraw)
-        if oldvalue:
-            oldvalue = json.loads(oldvalue)
-            if oldvalue['version'] >= value['version']:
-                raise ValueError(
-                    'Version is too old (existing [{}], new [{}])'.format(
-                        oldvalue['version'],
-                        value['version'],
-                    )
+            )
+    return value
+
+
+def verify(hashed_rec_key, value):
+    """
+    Checks the record key hash and signature of a prechecked record.
+    Returns the record key and publisher fingerprint.
+    """
+    key = binascii.unhexlify(value['key'])
+    fingerprint = gen_fingerprint(key)
+    rec_key = '{}:{}'.format(value['name'], fingerprint)
+    if hashed_rec_key is not None:
+        confirm_hashed_rec_key = kademlia.utils.digest(rec_key)
+        if confirm_hashed_rec_key != hashed_rec_key:
+            raise ValueError(
+                'Hashed record keys don\'t match '
+                '(got [{}], expected [{}])'.format(
+                    binascii.hexlify(hashed_rec_key),
+                    binascii.hexlify(confirm_hashed_rec_key),
                 )
+            )
+    signature = binascii.unhexlify(value['signature'])
+    nacl.signing.VerifyKey(key, encoder=eraw).verify(
+        plaintext(value), signature, encoder=eraw)
+    return rec_key, fingerprint
+
+
+def validate(args, hashed_rec_key, value, oldvalue):
+    try:
+        rec_key, fingerprint = verify(
+            hashed_rec_key, precheck(value, oldvalue))
         return True, rec_key, fingerprint
     except Exception as e:
         if args.verbose:
             log_info('Failed validation: {}, value {}'.format(e, value))
         return False, None, None
+
+
+def split_record_path(key):
+    """
+    Splits a requested resource id into the record key and a path to append
+    to the record's message.
+    """
+    key = strip_protocol(key)
+    if key.count(':') != 1:
+        raise ValueError('Invalid resource id')
+    try:
+        key, path = key.split('/', 1)
+        path = '/' + path
+    except ValueError:
+        path = ''
+    return key, path
+
+
+def respond_record(value, request, path, redirect_template):
+    if not value:
+        request.write(NoResource().render(request))
+    else:
+        value = json.loads(value)
+        if any('text/html' in val for val in request.requestHeaders.getRawHeaders('Accept', [])):
+            message = value['message'] + path
+            if urlmatch.match(message) and '\'' not in message and '"' not in message:
+                request.write(redirect_template.format(
+                    resource=message).encode('utf-8'))
+            else:
+                request.write(message.encode('utf-8'))
+        else:
+            request.write(json.dumps(value))
+    request.finish()
+
+
+def verify_batch(batch):
+    """
+    Verifies a batch of (hashed key, value, prechecked record) triples.
+    Returns (hashed key, value, record key, fingerprint, name) for each valid
+    record.
+    """
+    out = []
+    for key, value, record in batch:
+        try:
+            rec_key, fingerprint = verify(key, record)
+        except Exception:
+            continue
+        out.append((key, value, rec_key, fingerprint, record['name']))
+    return out
+
+
+def is_local(request):
+    return request.getClientIP() in ('127.0.0.1', '::1')
+
+
+class TokenBucket:
+    """
+    Allows `rate` operations per second on average, with bursts of up to
+    `burst` operations.
+    """
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = now
+
+    def take(self, now):
+        self.tokens = min(
+            self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
  
 
+class PublisherIndex:
+    """
+    Maps publisher fingerprints to the names they've published, and each name
+    to the key its record is stored under.
+    """
+    def __init__(self):
+        self.names = {}
+        self.keys = {}
+
+    def add(self, key, fingerprint, name):
+        self.keys[key] = (fingerprint, name)
+        self.names.setdefault(fingerprint, {})[name] = key
+
+    def discard(self, key):
+        fingerprint, name = self.keys.pop(key, (None, None))
+        if fingerprint is None:
+            return
+        names = self.names[fingerprint]
+        del names[name]
+        if not names:
+            del self.names[fingerprint]
+
+    def get(self, fingerprint):
+        return self.names.get(fingerprint, {})
+
+
 class Storage:
     """
     Kademlia storage implementation.
 
-    Three responsibilities:
+    Four responsibilities:
     - Storing data
     - Listing old keys to refresh
     - Keeping a record of data popularity and evicting unpopular data when
       a storage limit is reached.
+    - Limiting how many signature verifications each peer can trigger.
+
+    `source` is set to the address of the storing peer for the duration of a
+    STORE rpc so writes can be attributed.  Each callable in `listeners` is
+    called with the record key and value of every accepted write.
     """
     implements(kademlia.storage.IStorage)
 
     max_len = 5000
+    max_sources = 1000
 
     def __init__(self, args, ttl=604800, time=time):
         self.args = args
@@ -143,12 +300,25 @@ class Storage:
 
         self.step = ttl
 
+        self.listeners = []
+        self.index = PublisherIndex()
+
+        # admission
+        self.source = None
+        self.buckets = OrderedDict()
+        self.stats = {
+            'accepted': 0,
+            'rejected': 0,
+            'throttled': 0,
+        }
+
     def cull(self):
         if len(self.popularity_queue) > self.max_len:
             key = self.popularity_queue.pop()
             if self.args.verbose:
                 log_info('Dropping key {} (over count {})'.format(binascii.hexlify(key), self.max_len))
             del self.age_dict[key]
+            self.index.discard(key)
         if len(self.future_popularity_queue) > self.max_len:
             key = self.future_popularity_queue.pop()
             if self.args.verbose:
@@ -162,6 +332,29 @@ class Storage:
             current = self.future_popularity_queue.get(key, self.time.time())
             self.future_popularity_queue[key] = current + self.step
 
+    def admit(self, source):
+        if source is None:
+            return True
+        now = self.time.time()
+        bucket = self.buckets.pop(source, None)
+        if bucket is None:
+            bucket = TokenBucket(
+                self.args.store_rate, self.args.store_burst, now)
+        self.buckets[source] = bucket
+        if len(self.buckets) > self.max_sources:
+            self.buckets.popitem(last=False)
+        return bucket.take(now)
+
+    def publisher(self, fingerprint):
+        """
+        Returns the stored values published under `fingerprint` by name,
+        without affecting popularity.
+        """
+        return dict(
+            (name, self.age_dict[key][1])
+            for name, key in self.index.get(fingerprint).items()
+        )
+
     def _tripleIterable(self):
         ikeys = self.age_dict.iterkeys()
         ibirthday = imap(operator.itemgetter(0), self.age_dict.itervalues())
@@ -170,16 +363,44 @@ class Storage:
 
     # interface methods below
     def __setitem__(self, key, value):
-        age, oldvalue = self.age_dict.get(key) or self.time.time(), None
-        if not validate(self.args, key, value, oldvalue)[0]:
+        age, oldvalue = self.age_dict.get(key, (self.time.time(), None))
+        try:
+            record = precheck(value, oldvalue)
+        except Exception as e:
+            self.stats['rejected'] += 1
+            if self.args.verbose:
+                log_info('Rejected store from {}: {}'.format(self.source, e))
+            return
+        if not self.admit(self.source):
+            self.stats['throttled'] += 1
+            if self.args.verbose:
+                log_info('Throttled store from {}'.format(self.source))
             return
+        try:
+            rec_key, fingerprint = verify(key, record)
+        except Exception as e:
+            self.stats['rejected'] += 1
+            if self.args.verbose:
+                log_info('Rejected store from {}: {}'.format(self.source, e))
+            return
+        self.stats['accepted'] += 1
+        self.insert(key, value, rec_key, fingerprint, record['name'])
+
+    def insert(self, key, value, rec_key, fingerprint, name):
+        """
+        Stores a value that has already been validated.
+        """
+        age, oldvalue = self.age_dict.get(key, (None, None))
         if oldvalue is not None:
             self.age_dict[key] = (age, value)
         else:
             age = self.future_popularity_queue.pop(key, self.time.time())
             self.age_dict[key] = (self.time.time(), value)
             self.popularity_queue[key] = age
+        self.index.add(key, fingerprint, name)
         self.cull()
+        for listener in self.listeners:
+            listener(rec_key, value)
 
     def __getitem__(self, key):
         self.inc_popularity(key)
@@ -204,6 +425,482 @@ class Storage:
         return self.age_dict.iteritems()
 
 
+class HedgedLookup:
+    """
+    Finds the highest version of a record within a latency budget.
+
+    Up to `alpha` queries are kept moving at once; a query that hasn't been
+    answered within the query timeout stops counting towards that, so a
+    duplicate goes to the next closest contact.  Once a valid record is found
+    the lookup keeps collecting for the grace period and then returns the
+    highest version seen, storing it to the closest contact that answered
+    without it.
+    """
+    def __init__(self, args, kserver, rec_key):
+        self.args = args
+        self.storage = kserver.storage
+        self.protocol = kserver.protocol
+        self.ksize = kserver.ksize
+        self.alpha = kserver.alpha
+        self.node = Node(kademlia.utils.digest(rec_key))
+        self.nearest = NodeHeap(self.node, kserver.ksize)
+        self.answers = []
+        self.best = None
+        self.active = 0
+        self.pending = 0
+        self.timers = []
+        self.hedges = []
+        self.result = defer.Deferred()
+
+    def find(self):
+        self.timers.append(
+            reactor.callLater(self.args.lookup_budget, self.finish))
+        local = self.storage.get(self.node.id)
+        if local is not None:
+            self.found(local)
+        self.nearest.push(self.protocol.router.findNeighbors(self.node))
+        self.refill()
+        return self.result
+
+    def refill(self):
+        if self.result.called:
+            return
+        while self.active < self.alpha:
+            uncontacted = self.nearest.getUncontacted()
+            if not uncontacted:
+                break
+            peer = uncontacted[0]
+            self.nearest.markContacted(peer)
+            self.active += 1
+            self.pending += 1
+            hedge = reactor.callLater(
+                self.args.query_timeout, self.hedge)
+            self.hedges.append(hedge)
+            d = self.protocol.callFindValue(peer, self.node)
+            d.addErrback(lambda failure: (False, None))
+            d.addCallback(self.answered, peer, hedge)
+        if not self.pending:
+            self.finish()
+
+    def hedge(self):
+        self.active -= 1
+        self.refill()
+
+    def answered(self, result, peer, hedge):
+        if self.result.called:
+            return
+        self.pending -= 1
+        self.hedges.remove(hedge)
+        if hedge.active():
+            hedge.cancel()
+            self.active -= 1
+        response = RPCFindResponse(result)
+        if not response.happened():
+            self.nearest.remove([peer.id])
+        elif response.hasValue():
+            self.answers.append((peer, self.found(response.getValue())))
+        else:
+            self.nearest.push(response.getNodeList())
+            self.answers.append((peer, None))
+        self.refill()
+
+    def found(self, value):
+        """
+        Returns the version of `value` if it's valid, otherwise None.
+        """
+        if not validate(self.args, self.node.id, value, None)[0]:
+            return None
+        version = json.loads(value)['version']
+        if self.best is None or json.loads(self.best)['version'] < version:
+            self.best = value
+        if len(self.timers) == 1:
+            self.timers.append(
+                reactor.callLater(self.args.lookup_grace, self.finish))
+        return version
+
+    def finish(self):
+        if self.result.called:
+            return
+        for timer in self.timers + self.hedges:
+            if timer.active():
+                timer.cancel()
+        if self.best is not None:
+            best_version = json.loads(self.best)['version']
+            stale = NodeHeap(self.node, self.ksize)
+            stale.push([
+                peer for peer, version in self.answers
+                if version is None or version < best_version
+            ])
+            for peer in stale:
+                self.protocol.callStore(peer, self.node.id, self.best)
+                break
+        self.result.callback(self.best)
+
+
+class Resolver:
+    """
+    Looks up and validates records for the web and DNS frontends.  Valid
+    records are cached for `cache_ttl` seconds and concurrent lookups of the
+    same key share one DHT lookup.
+    """
+    max_len = 5000
+
+    def __init__(self, args, lookup, time=time):
+        self.args = args
+        self.lookup = lookup
+        self.time = time
+        self.cache = OrderedDict()
+        self.pending = {}
+
+    def resolve(self, key):
+        cached = self.cache.get(key)
+        if cached is not None and cached[0] > self.time.time():
+            return defer.succeed(cached[1])
+        d = defer.Deferred()
+        if key in self.pending:
+            self.pending[key].append(d)
+            return d
+        self.pending[key] = [d]
+        def done(value):
+            if value:
+                valid, rec_key, ign = validate(self.args, None, value, None)
+                if valid and rec_key == key:
+                    self.cache_value(key, value)
+                else:
+                    value = None
+            for waiter in self.pending.pop(key):
+                waiter.callback(value)
+        def failed(failure):
+            for waiter in self.pending.pop(key):
+                waiter.errback(failure)
+        self.lookup(key).addCallbacks(done, failed)
+        return d
+
+    def put(self, key, value):
+        """
+        Updates the cached record for `key` with a newly seen value.  Keys
+        that aren't cached are ignored, so writes nobody looked up don't push
+        out cached records.
+        """
+        if key in self.cache:
+            self.cache_value(key, value)
+
+    def cache_value(self, key, value):
+        now = self.time.time()
+        cached = self.cache.pop(key, None)
+        if cached is not None and cached[0] > now and \
+                json.loads(cached[1])['version'] > json.loads(value)['version']:
+            value = cached[1]
+        self.cache[key] = (now + self.args.cache_ttl, value)
+        if len(self.cache) > self.max_len:
+            self.cache.popitem(last=False)
+
+
+class DNSFrontend:
+    """
+    Answers DNS queries for `<name>.<fingerprint>.<tld>`, with the fingerprint
+    split into two 32 character labels to fit DNS label limits.  TXT and URI
+    queries return the message; A and AAAA queries return the host of
+    `host:port` messages, as an address or a CNAME.
+    """
+    def __init__(self, args, resolver):
+        self.args = args
+        self.resolver = resolver
+        self.tld = args.dns_tld.strip('.').lower().split('.')
+
+    def query(self, query, timeout=None):
+        name = str(query.name)
+        labels = name.rstrip('.').split('.')
+        tld_len = len(self.tld)
+        if len(labels) < tld_len + 3 or \
+                [label.lower() for label in labels[-tld_len:]] != self.tld:
+            return defer.fail(dns.DomainError(name))
+        key = '{}:{}'.format(
+            '.'.join(labels[:-tld_len - 2]),
+            ''.join(labels[-tld_len - 2:-tld_len]).lower())
+        d = self.resolver.resolve(key)
+        d.addCallback(self.answer, query)
+        return d
+
+    def answer(self, value, query):
+        name = str(query.name)
+        if not value:
+            raise dns.DomainError(name)
+        message = json.loads(value)['message'].encode('utf-8')
+        ttl = self.args.cache_ttl
+        answers = []
+        if query.type in (dns.TXT, dns.ALL_RECORDS):
+            answers.append(dns.RRHeader(name, dns.TXT, ttl=ttl,
+                payload=dns.Record_TXT(
+                    *[message[i:i + 255] for i in range(0, len(message), 255)],
+                    ttl=ttl)))
+        if query.type in (dns_uri_type, dns.ALL_RECORDS):
+            answers.append(dns.RRHeader(name, dns_uri_type, ttl=ttl,
+                payload=dns.UnknownRecord(
+                    struct.pack('!HH', 10, 1) + message, ttl=ttl)))
+        if query.type in (dns.A, dns.AAAA, dns.ALL_RECORDS):
+            match = hostportmatch.match(message)
+            if match:
+                host = match.group(1) or match.group(2)
+                if is_address(socket.AF_INET, host):
+                    if query.type != dns.AAAA:
+                        answers.append(dns.RRHeader(name, dns.A, ttl=ttl,
+                            payload=dns.Record_A(host, ttl=ttl)))
+                elif is_address(socket.AF_INET6, host):
+                    if query.type != dns.A:
+                        answers.append(dns.RRHeader(name, dns.AAAA, ttl=ttl,
+                            payload=dns.Record_AAAA(host, ttl=ttl)))
+                else:
+                    answers.append(dns.RRHeader(name, dns.CNAME, ttl=ttl,
+                        payload=dns.Record_CNAME(host, ttl=ttl)))
+        return answers, [], []
+
+
+class Watcher:
+    """
+    Streams newer versions of records to subscribed requests as server-sent
+    events.  Each watched key is looked up periodically, once for all of its
+    subscribers.
+    """
+    def __init__(self, args, lookup):
+        self.args = args
+        self.lookup = lookup
+        self.subscribers = {}
+        self.values = {}
+        self.loops = {}
+
+    def subscribe(self, request, keys):
+        for key in keys:
+            if key not in self.subscribers:
+                self.subscribers[key] = set()
+                self.loops[key] = LoopingCall(self.refresh, key)
+                self.loops[key].start(self.args.watch_interval)
+            self.subscribers[key].add(request)
+            if key in self.values:
+                self._send(request, key, self.values[key])
+        def unsubscribe(ignored):
+            for key in keys:
+                subscribers = self.subscribers.get(key)
+                if subscribers is None:
+                    continue
+                subscribers.discard(request)
+                if not subscribers:
+                    del self.subscribers[key]
+                    loop = self.loops.pop(key)
+                    if loop.running:
+                        loop.stop()
+                    self.values.pop(key, None)
+        request.notifyFinish().addBoth(unsubscribe)
+
+    def refresh(self, key):
+        def check(value):
+            if not value:
+                return
+            valid, rec_key, ign = validate(self.args, None, value, None)
+            if valid and rec_key == key:
+                self.notify(key, value)
+        d = self.lookup(key)
+        d.addCallback(check)
+        d.addErrback(twisted.python.log.err)
+        return d
+
+    def notify(self, key, value):
+        if key not in self.subscribers:
+            return
+        old = self.values.get(key)
+        if old is not None and \
+                json.loads(old)['version'] >= json.loads(value)['version']:
+            return
+        self.values[key] = value
+        for request in self.subscribers[key]:
+            self._send(request, key, value)
+
+    @staticmethod
+    def _send(request, key, value):
+        value = json.loads(value)
+        request.write('event: record\nid: {}\ndata: {}\n\n'.format(
+            value['version'], json.dumps(value)))
+
+
+class WorkerProxyClient(proxy.ProxyClient):
+    lost = False
+
+    def handleResponsePart(self, buffer):
+        if not self.lost:
+            proxy.ProxyClient.handleResponsePart(self, buffer)
+
+    def handleResponseEnd(self):
+        if not self.lost:
+            proxy.ProxyClient.handleResponseEnd(self)
+
+
+class WorkerProxyClientFactory(proxy.ProxyClientFactory):
+    """
+    Drops the connection to the DHT process when the client's request is
+    lost, so streams like /watch don't outlive their clients.
+    """
+    protocol = WorkerProxyClient
+
+    def __init__(self, *pargs):
+        proxy.ProxyClientFactory.__init__(self, *pargs)
+        self.client = None
+        self.lost = False
+        self.father.notifyFinish().addErrback(self.downstreamLost)
+
+    def buildProtocol(self, addr):
+        if self.lost:
+            return None
+        self.client = proxy.ProxyClientFactory.buildProtocol(self, addr)
+        return self.client
+
+    def clientConnectionFailed(self, connector, reason):
+        if not self.lost:
+            proxy.ProxyClientFactory.clientConnectionFailed(
+                self, connector, reason)
+
+    def downstreamLost(self, reason):
+        self.lost = True
+        if self.client is not None:
+            self.client.lost = True
+            self.client.transport.loseConnection()
+
+
+class WorkerResource(resource.Resource):
+    """
+    Web interface of a worker process.  Record lookups are answered from the
+    worker's own cache, with misses forwarded to the DHT process; every other
+    request is proxied to the DHT process whole.  Records published through
+    the worker replace the worker's cached version once the DHT process has
+    accepted them.
+    """
+    isLeaf = True
+
+    def __init__(self, args, resolver, redirect_template):
+        resource.Resource.__init__(self)
+        self.args = args
+        self.resolver = resolver
+        self.redirect_template = redirect_template
+
+    def render(self, request):
+        key = strip_protocol(urllib.unquote(request.path[1:]))
+        if key == 'snapshot' and not is_local(request):
+            return resource.ForbiddenResource().render(request)
+        if request.method == 'POST' and key != 'snapshot':
+            value = request.content.getvalue()
+            def published(ignored):
+                if request.code != 200:
+                    return
+                valid, rec_key, ign = validate(self.args, None, value, None)
+                if valid:
+                    self.resolver.put(rec_key, value)
+            request.notifyFinish().addCallback(published)
+        if request.method != 'GET' or key.count(':') != 1:
+            backend = proxy.ReverseProxyResource(
+                '127.0.0.1', self.args.backend_port, request.path)
+            backend.proxyClientFactoryClass = WorkerProxyClientFactory
+            return backend.render(request)
+        key, path = split_record_path(key)
+        def failed(failure):
+            log_info('Lookup of {} failed: {}'.format(
+                key, failure.getErrorMessage()))
+            request.setResponseCode(502)
+            request.write('Bizast node unavailable')
+            request.finish()
+        d = self.resolver.resolve(key)
+        d.addCallback(
+            respond_record, request, path, self.redirect_template)
+        d.addErrback(failed)
+        return server.NOT_DONE_YET
+
+
+class WorkerProcess(protocol.ProcessProtocol):
+    """
+    Restarts its worker when it exits, unless the reactor is shutting down.
+    """
+    def __init__(self, spawn):
+        self.spawn = spawn
+        self.stopping = False
+
+    def processEnded(self, reason):
+        if not self.stopping:
+            log_info('Worker exited ({}), restarting'.format(
+                reason.getErrorMessage()))
+            reactor.callLater(1, self.spawn)
+
+
+def start_workers(args, backend_port):
+    """
+    Opens the web port and spawns `args.workers` processes that accept
+    connections on it.
+    """
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(('', args.webport))
+    listener.listen(128)
+    listener.setblocking(False)
+    fd = listener.fileno()
+    argv = [
+        sys.executable, '-m', 'bizast.bizast',
+        '--worker-fd', str(fd),
+        '--backend-port', str(backend_port),
+        '--cache-ttl', str(args.cache_ttl),
+    ]
+    if args.verbose:
+        argv.append('--verbose')
+    workers = []
+    def spawn():
+        worker = WorkerProcess(spawn)
+        workers.append(worker)
+        reactor.spawnProcess(
+            worker, sys.executable, argv, env=os.environ,
+            childFDs={0: 0, 1: 1, 2: 2, fd: fd})
+    def stop():
+        listener.close()
+        for worker in workers:
+            worker.stopping = True
+            if worker.transport.pid is not None:
+                worker.transport.signalProcess('TERM')
+    reactor.addSystemEventTrigger('before', 'shutdown', stop)
+    for index in range(args.workers):
+        spawn()
+
+
+def worker_main(args):
+    log_observer = log.FileLogObserver(sys.stdout, log.INFO)
+    log_observer.start()
+
+    # Exit with the DHT process so orphaned workers don't hold the web port
+    parent = os.getppid()
+    def check_parent():
+        if os.getppid() != parent:
+            log_info('DHT process exited, stopping worker')
+            reactor.stop()
+    LoopingCall(check_parent).start(1)
+
+    agent = Agent(reactor, pool=HTTPConnectionPool(reactor))
+    def fetch(key):
+        def received(response):
+            body = readBody(response)
+            if response.code != 200:
+                body.addCallback(lambda ignored: None)
+            return body
+        d = agent.request(
+            'GET',
+            'http://127.0.0.1:{}/{}'.format(
+                args.backend_port, urllib.quote(key)),
+            Headers({'Accept': ['application/json']}))
+        d.addCallback(received)
+        return d
+    resolver = Resolver(args, fetch)
+
+    with open(res('redirect_template.html'), 'r') as template:
+        redirect_template = template.read()
+    reactor.adoptStreamPort(
+        args.worker_fd,
+        socket.AF_INET,
+        server.Site(WorkerResource(args, resolver, redirect_template)))
+
+
 @defer.inlineCallbacks
 def twisted_main(args):
     log_observer = log.FileLogObserver(sys.stdout, log.INFO)
@@ -220,36 +917,113 @@ def twisted_main(args):
         if args.verbose:
             log_info('Failed to load state: {}'.format(e))
     republish = state.get('republish', {})
+    republish_index = PublisherIndex()
+    for rec_key, value in republish.items():
+        republish_index.add(
+            rec_key, rec_key.rsplit(':', 1)[1], json.loads(value)['name'])
 
     # Set up kademlia
 
+    storage = Storage(args)
     kserver = Server(
         ksize=state.get('ksize', 20), 
         alpha=state.get('alpha', 3), 
         seed=binascii.unhexlify(state['seed']) if 'seed' in state else None, 
-        storage=Storage(args))
-    bootstraps = map(tuple, state.get('bootstrap', []))
-    for bootstrap in args.bootstrap:
-        bhost, bport = bootstrap.split(':', 2)
-        bport = int(bport)
-        bhost_ip = yield reactor.resolve(bhost)
-        bootstraps.append((bhost_ip, bport))
-    if args.verbose:
-        log_info('Bootstrapping hosts: {}'.format(bootstraps))
-    kserver.bootstrap(bootstraps)
+        storage=storage)
+
+    # Attribute stores to the sending peer for admission control
+    rpc_store = kserver.protocol.rpc_store
+    def attributed_rpc_store(sender, nodeid, key, value):
+        storage.source = sender[0]
+        try:
+            return rpc_store(sender, nodeid, key, value)
+        finally:
+            storage.source = None
+    kserver.protocol.rpc_store = attributed_rpc_store
+
+    # Record when routing table contacts were last heard from
+    last_seen = {}
+    router = kserver.protocol.router
+    add_contact = router.addContact
+    def stamped_add_contact(node):
+        last_seen[node.id] = time.time()
+        return add_contact(node)
+    router.addContact = stamped_add_contact
+
+    def lookup(rec_key):
+        if args.lookup == 'hedged':
+            return HedgedLookup(args, kserver, rec_key).find()
+        return kserver.get(rec_key)
+
+    watcher = Watcher(args, lookup)
+    storage.listeners.append(watcher.notify)
+    resolver = Resolver(args, lookup)
+    storage.listeners.append(resolver.put)
+
+    if args.dnsport is not None:
+        dns_frontend = DNSFrontend(args, resolver)
+        dns_factory = dnsserver.DNSServerFactory(clients=[dns_frontend])
+        dns_factory.resolver = dns_frontend
+        dnsudpserver = internet.UDPServer(
+            args.dnsport,
+            dns.DNSDatagramProtocol(dns_factory),
+            interface=args.dns_interface)
+        dnsudpserver.startService()
 
     udpserver = internet.UDPServer(args.dhtport, kserver.protocol)
     udpserver.startService()
 
+    # Restore the routing table; recently seen contacts are used as is and
+    # the rest are pinged in parallel
+    start = time.time()
+    stale = []
+    for node_id, host, port, seen in state.get('routing', []):
+        node = Node(binascii.unhexlify(node_id), host, port)
+        if start - seen < fresh_contact_age:
+            add_contact(node)
+            last_seen[node.id] = seen
+        else:
+            stale.append(node)
+    if args.verbose:
+        log_info('Restored {} contacts, pinging {} stale contacts'.format(
+            len(state.get('routing', [])) - len(stale), len(stale)))
+    yield defer.DeferredList(
+        [kserver.protocol.callPing(node) for node in stale],
+        consumeErrors=True)
+    if kserver.bootstrappableNeighbors():
+        kserver.bootstrap(kserver.bootstrappableNeighbors())
+    else:
+        bootstraps = map(tuple, state.get('bootstrap', []))
+        for bootstrap in args.bootstrap:
+            bhost, bport = bootstrap.split(':', 2)
+            bport = int(bport)
+            bhost_ip = yield reactor.resolve(bhost)
+            bootstraps.append((bhost_ip, bport))
+        if args.verbose:
+            log_info('Bootstrapping hosts: {}'.format(bootstraps))
+        yield kserver.bootstrap(bootstraps)
+
     # Set up state saver
     def save_state():
         if args.verbose:
             log_info('Saving state')
+            log_info('Store stats: {}'.format(storage.stats))
         state['ksize'] = kserver.ksize
         state['alpha'] = kserver.alpha
         state['seed'] = binascii.hexlify(kserver.node.seed)
         state['republish'] = republish
-        state['bootstrap'] = kserver.bootstrappableNeighbors()
+        nodes = [
+            node for bucket in router.buckets for node in bucket.getNodes()]
+        current = dict(
+            (node.id, last_seen.get(node.id, 0)) for node in nodes)
+        last_seen.clear()
+        last_seen.update(current)
+        state['routing'] = [
+            [binascii.hexlify(node.id), node.ip, node.port,
+                last_seen[node.id]]
+            for node in nodes
+        ]
+        state.pop('bootstrap', None)
         with open(os.path.join(root, 'state.json.1'), 'w') as prestate:
             prestate.write(json.dumps(state))
         os.rename(
@@ -271,6 +1045,63 @@ def twisted_main(args):
         republish_loop.start(1 * 60 * 60 * 24)
     deferLater(reactor, 60, start_republish)
 
+    # Set up snapshot importing
+    def responsible(key):
+        node = Node(key)
+        neighbors = router.findNeighbors(node)
+        if len(neighbors) < kserver.ksize:
+            return True
+        return kserver.node.distanceTo(node) < \
+            max(neighbor.distanceTo(node) for neighbor in neighbors)
+
+    @defer.inlineCallbacks
+    def import_snapshot(lines):
+        result = {
+            'imported': 0,
+            'rejected': 0,
+            'skipped': 0,
+        }
+        records = {}
+        for value in lines:
+            if not value.strip():
+                continue
+            try:
+                record = precheck(value, None)
+                key = kademlia.utils.digest('{}:{}'.format(
+                    record['name'],
+                    gen_fingerprint(binascii.unhexlify(record['key']))))
+            except Exception:
+                result['rejected'] += 1
+                continue
+            if not responsible(key):
+                result['skipped'] += 1
+                continue
+            if key in records:
+                result['skipped'] += 1
+                if records[key][2]['version'] >= record['version']:
+                    continue
+            records[key] = (key, value, record)
+        records = records.values()
+        batches = yield defer.gatherResults([
+            threads.deferToThread(
+                verify_batch, records[start:start + snapshot_batch_len])
+            for start in range(0, len(records), snapshot_batch_len)
+        ])
+        verified = 0
+        for batch in batches:
+            verified += len(batch)
+            for key, value, rec_key, fingerprint, name in batch:
+                age, oldvalue = storage.age_dict.get(key, (None, None))
+                if oldvalue is not None and json.loads(oldvalue)['version'] >= \
+                        json.loads(value)['version']:
+                    result['skipped'] += 1
+                    continue
+                storage.insert(key, value, rec_key, fingerprint, name)
+                result['imported'] += 1
+        result['rejected'] += len(records) - verified
+        log_info('Imported snapshot: {}'.format(result))
+        defer.returnValue(result)
+
     # Set up webserver
     with open(res('redirect_template.html'), 'r') as template:
         redirect_template = template.read()
@@ -286,48 +1117,82 @@ def twisted_main(args):
             if key == 'icon-bizast-off.png':
                 with open(res('icon-bizast-off.png'), 'r') as static:
                     return static.read()
-            if key.startswith(webprotocol):
-                key = key[len(webprotocol):]
-            if key.startswith(webprotocol2):
-                key = key[len(webprotocol2):]
-            if key.count(':') != 1:
-                raise ValueError('Invalid resource id')
-            try:
-                key, path = key.split('/', 1)
-                path = '/' + path
-            except ValueError:
-                path = ''
-            def respond(value):
-                if not value:
-                    request.write(NoResource().render(request))
-                else:
-                    valid, ign, ign = validate(args, None, value, None)
-                    if not valid:
-                        request.write(NoResource('Received invalid resource: {}'.format(value)).render(request))
-                    else:
-                        value = json.loads(value)
-                        if any('text/html' in val for val in request.requestHeaders.getRawHeaders('Accept', [])):
-                            message = value['message'] + path
-                            if urlmatch.match(message) and '\'' not in message and '"' not in message:
-                                request.write(redirect_template.format(
-                                    resource=message).encode('utf-8'))
-                            else:
-                                request.write(message.encode('utf-8'))
-                        else:
-                            request.write(json.dumps(value))
-                request.finish()
+            if key == 'stats':
+                request.setHeader('Content-Type', 'application/json')
+                return json.dumps(storage.stats)
+            if key.startswith('publisher/'):
+                fingerprint = key[len('publisher/'):].lower()
+                offset = int(request.args.get('offset', [0])[0])
+                limit = min(
+                    int(request.args.get('limit', [100])[0]), max_page_len)
+                if offset < 0 or limit < 0:
+                    raise ValueError('Invalid page')
+                records = {}
+                for name, value in storage.publisher(fingerprint).items():
+                    records[name] = json.loads(value)
+                for name, rec_key in republish_index.get(fingerprint).items():
+                    value = json.loads(republish[rec_key])
+                    if name not in records or \
+                            records[name]['version'] < value['version']:
+                        records[name] = value
+                names = sorted(records.keys())
+                request.setHeader('Content-Type', 'application/json')
+                return json.dumps({
+                    'fingerprint': fingerprint,
+                    'total': len(names),
+                    'offset': offset,
+                    'records': [
+                        records[name]
+                        for name in names[offset:offset + limit]
+                    ],
+                })
+            if key == 'snapshot':
+                if not is_local(request):
+                    return resource.ForbiddenResource().render(request)
+                request.setHeader('Content-Type', 'application/x-ndjson')
+                values = [value for key, (age, value) in storage.iteritems()]
+                values.extend(republish.values())
+                for value in values:
+                    request.write(json.dumps(
+                        json.loads(value), separators=(',', ':')) + '\n')
+                return ''
+            if key == 'watch':
+                keys = map(strip_protocol, request.args.get('key', []))
+                if not keys or any(key.count(':') != 1 for key in keys):
+                    raise ValueError('Invalid resource id')
+                request.setHeader('Content-Type', 'text/event-stream')
+                request.setHeader('Cache-Control', 'no-cache')
+                request.write(': watching\n\n')
+                watcher.subscribe(request, keys)
+                return server.NOT_DONE_YET
+            key, path = split_record_path(key)
             log.msg('GET: key [{}]'.format(key))
-            d = kserver.get(key)
-            d.addCallback(respond)
+            d = resolver.resolve(key)
+            d.addCallback(respond_record, request, path, redirect_template)
             return server.NOT_DONE_YET
 
         def render_POST(self, request):
+            if urllib.unquote(request.path[1:]) == 'snapshot':
+                if not is_local(request):
+                    return resource.ForbiddenResource().render(request)
+                request.content.seek(0)
+                def respond(result):
+                    request.setHeader('Content-Type', 'application/json')
+                    request.write(json.dumps(result))
+                    request.finish()
+                d = import_snapshot(request.content.read().splitlines())
+                d.addCallback(respond)
+                return server.NOT_DONE_YET
             value = request.content.getvalue()
             valid, rec_key, fingerprint = validate(args, None, value, None)
             if not valid:
                 raise ValueError('Failed verification')
             log.msg('SET: key [{}] = val [{}]'.format(rec_key, value))
             republish[rec_key] = value
+            republish_index.add(
+                rec_key, fingerprint, json.loads(value)['name'])
+            watcher.notify(rec_key, value)
+            resolver.put(rec_key, value)
             def respond(result):
                 request.write('Success')
                 request.finish()
@@ -344,15 +1209,59 @@ def twisted_main(args):
             if key not in republish:
                 raise ValueError('Not republishing key {}'.format(key))
             del republish[key]
+            republish_index.discard(key)
             return 'Success'
 
-    webserver = internet.TCPServer(args.webport, server.Site(Resource()))
-    webserver.startService()
+    if args.workers:
+        backend = reactor.listenTCP(
+            0, server.Site(Resource()), interface='127.0.0.1')
+        start_workers(args, backend.getHost().port)
+    else:
+        webserver = internet.TCPServer(args.webport, server.Site(Resource()))
+        webserver.startService()
+    log_info('Ready after {:.1f}s with {} contacts'.format(
+        time.time() - start, sum(len(bucket) for bucket in router.buckets)))
+
+def export_main(args):
+    resp = requests.get(
+        'http://localhost:{}/snapshot'.format(args.webport), stream=True)
+    resp.raise_for_status()
+    count = 0
+    with gzip.open(args.snapshot, 'wb') as snapshot:
+        for line in resp.iter_lines():
+            if line:
+                snapshot.write(line + '\n')
+                count += 1
+    print('Exported {} records to {}'.format(count, args.snapshot))
+
+
+def import_main(args):
+    with gzip.open(args.snapshot, 'rb') as snapshot:
+        data = snapshot.read()
+    resp = requests.post(
+        'http://localhost:{}/snapshot'.format(args.webport), data=data)
+    resp.raise_for_status()
+    print(resp.text)
+
 
 def main():
     parser = argparse.ArgumentParser(
         description='Become bizast',
     )
+    parser.add_argument(
+        'command',
+        nargs='?',
+        help='run (default) starts a node; export and import copy the '
+            'stored records of the node running on --webport to or from a '
+            'snapshot file',
+        choices=['run', 'export', 'import'],
+        default='run',
+    )
+    parser.add_argument(
+        'snapshot',
+        nargs='?',
+        help='Snapshot file for export and import',
+    )
     parser.add_argument(
         '-d',
         '--dhtport',
@@ -374,6 +1283,88 @@ def main():
         help='Bootstrap DHT with host:port',
         default=['soyvindication.dyndns.org:26282'],
     )
+    parser.add_argument(
+        '--store-rate',
+        help='Signature verifications per second allowed for each storing peer',
+        type=float,
+        default=1,
+    )
+    parser.add_argument(
+        '--store-burst',
+        help='Signature verifications allowed in a burst for each storing peer',
+        type=float,
+        default=20,
+    )
+    parser.add_argument(
+        '--lookup',
+        help='Lookup strategy for web requests: iterative waits for the full '
+            'DHT walk, hedged duplicates slow queries and returns early',
+        choices=['iterative', 'hedged'],
+        default='iterative',
+    )
+    parser.add_argument(
+        '--lookup-budget',
+        help='Seconds a hedged lookup may take in total',
+        type=float,
+        default=5,
+    )
+    parser.add_argument(
+        '--query-timeout',
+        help='Seconds before a hedged lookup queries an alternate contact',
+        type=float,
+        default=1,
+    )
+    parser.add_argument(
+        '--lookup-grace',
+        help='Seconds a hedged lookup keeps collecting newer versions after '
+            'finding a valid record',
+        type=float,
+        default=0.25,
+    )
+    parser.add_argument(
+        '--cache-ttl',
+        help='Seconds to cache looked up records',
+        type=int,
+        default=60,
+    )
+    parser.add_argument(
+        '--dnsport',
+        help='Serve bizast names over DNS on this UDP port',
+        type=int,
+    )
+    parser.add_argument(
+        '--dns-interface',
+        help='Interface to serve DNS on',
+        default='127.0.0.1',
+    )
+    parser.add_argument(
+        '--dns-tld',
+        help='Pseudo top level domain of names served over DNS',
+        default='bz',
+    )
+    parser.add_argument(
+        '--workers',
+        help='Number of web worker processes to start (POSIX only).  With 0, '
+            'the web interface is served by the DHT process',
+        type=int,
+        default=0,
+    )
+    parser.add_argument(
+        '--worker-fd',
+        help=argparse.SUPPRESS,
+        type=int,
+    )
+    parser.add_argument(
+        '--backend-port',
+        help=argparse.SUPPRESS,
+        type=int,
+    )
+    parser.add_argument(
+        '--watch-interval',
+        help='Seconds between lookups of keys with watching subscribers',
+        type=float,
+        default=300,
+    )
     parser.add_argument(
         '-v',
         '--verbose',
@@ -387,7 +1378,19 @@ def main():
     )
     args = parser.parse_args()
 
-    reactor.callWhenRunning(twisted_main, args)
+    if args.command in ('export', 'import'):
+        if not args.snapshot:
+            parser.error('{} requires a snapshot file'.format(args.command))
+        if args.command == 'export':
+            export_main(args)
+        else:
+            import_main(args)
+        return
+
+    if args.worker_fd is not None:
+        reactor.callWhenRunning(worker_main, args)
+    else:
+        reactor.callWhenRunning(twisted_main, args)
     reactor.run()
 
 if __name__ == '__main__':